@@ -3,11 +3,16 @@ import time
 import requests
 import random
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, redirect
 from dotenv import load_dotenv
 from openai import OpenAI
 from storage import StorageManager
+from export import EXPORT_FORMATS, stream_archive
+from events import EventLog
+from similarity import PromptIndex
+from recompress import GalleryRecompressor
 
 # Load environment variables
 load_dotenv()
@@ -20,12 +25,56 @@ API_KEY = os.getenv("IMAGE_GEN_API_KEY")
 BASE_URL = os.getenv("ARK_BASE_URL", "https://ark.ap-southeast.bytepluses.com/api/v3")
 ACCESS_CODE = os.getenv("ACCESS_CODE")  # Optional access code
 
+# Near-duplicate index over final prompts of gallery images
+prompt_index = PromptIndex()
+
 # Initialize Storage Manager
 # Use 'static/gallery' to store images publicly accessible via Flask
-storage_manager = StorageManager(base_dir='static/gallery', max_files=2000)
+# Image metadata (prompts) is kept outside 'static/' so it is never served publicly
+storage_manager = StorageManager(
+    base_dir='static/gallery',
+    max_files=2000,
+    prompt_index=prompt_index,
+    metadata_dir=os.getenv("GALLERY_METADATA_DIR", "gallery_metadata")
+)
+prompt_index.build(storage_manager)
+
+# Generation event log (JSONL, rotated by size) backing /admin/stats
+event_log = EventLog(
+    log_dir=os.getenv("EVENT_LOG_DIR", "logs"),
+    max_bytes=int(os.getenv("EVENT_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv("EVENT_LOG_BACKUP_COUNT", "5"))
+)
+
+# Background re-encoding of gallery images older than the hot window
+# (job state lives next to the event log, outside 'static/')
+recompressor = GalleryRecompressor(
+    storage_manager,
+    state_dir=os.path.join(event_log.log_dir, "recompress"),
+    target_format=os.getenv("RECOMPRESS_FORMAT", "webp"),  # 'webp' or 'png'
+    webp_quality=int(os.getenv("RECOMPRESS_WEBP_QUALITY", "90")),
+    hot_window_hours=float(os.getenv("RECOMPRESS_HOT_WINDOW_HOURS", "24")),
+    cpu_budget=float(os.getenv("RECOMPRESS_CPU_BUDGET", "0.1")),
+    io_budget_bytes=int(os.getenv("RECOMPRESS_IO_BUDGET_BYTES", str(5 * 1024 * 1024)))
+)
+
+def start_background_jobs():
+    """
+    Start background jobs that modify the gallery. Called by the server
+    (Gunicorn's post_worker_init hook, or __main__ below), never on import,
+    so scripts and tests that import this module leave the gallery alone.
+    """
+    if os.getenv("RECOMPRESS_ENABLED", "true").lower() == "true":
+        recompressor.start()
+
+# Similar gallery images are suggested above SIMILAR_MIN_SIMILARITY and,
+# when the client asks for it, reused (no API call) above REUSE_MIN_SIMILARITY
+SIMILAR_MIN_SIMILARITY = float(os.getenv("SIMILAR_MIN_SIMILARITY", "0.7"))
+REUSE_MIN_SIMILARITY = float(os.getenv("REUSE_MIN_SIMILARITY", "0.9"))
 
 # Rate Limiting Config
 MAX_PROMPT_LENGTH = 1000
+MAX_IMAGES_PER_REQUEST = int(os.getenv("MAX_IMAGES_PER_REQUEST", "4"))
 RANDOM_PROMPT_DAILY_LIMIT = int(os.getenv("RANDOM_PROMPT_DAILY_LIMIT", "200"))
 
 # Quotas per model ID
@@ -43,8 +92,8 @@ rate_limit_store = {
     }
 }
 
-def check_rate_limit(model_id):
-    """Check if daily limit is exceeded for a specific model"""
+def check_rate_limit(model_id, count=1):
+    """Check if generating `count` more images would exceed the daily limit for a model"""
     today = date.today()
     
     # Reset counter if new day
@@ -57,16 +106,18 @@ def check_rate_limit(model_id):
     
     if current_count >= max_limit:
         return False, f"Daily limit of {max_limit} images reached for this model. Try the other model!"
+    if current_count + count > max_limit:
+        return False, f"Only {max_limit - current_count} image(s) left today for this model. Request fewer images!"
         
     return True, ""
 
-def increment_rate_limit(model_id):
-    """Increment the daily counter for a specific model"""
+def increment_rate_limit(model_id, count=1):
+    """Increment the daily counter for a specific model by the number of images generated"""
     if model_id in rate_limit_store["counts"]:
-        rate_limit_store["counts"][model_id] += 1
+        rate_limit_store["counts"][model_id] += count
     else:
         # Handle unexpected model IDs safely
-        rate_limit_store["counts"][model_id] = 1
+        rate_limit_store["counts"][model_id] = count
 
 # Simple in-memory limiter for random prompts
 random_prompt_store = {
@@ -97,12 +148,15 @@ MODELS = {
     "model_1": {
         "name": os.getenv("MODEL_1_NAME", "Seedream 5.0 Lite"),
         "endpoint": os.getenv("MODEL_1_ENDPOINT"),
-        "size": os.getenv("MODEL_1_SIZE", "1920x1920")
+        "size": os.getenv("MODEL_1_SIZE", "1920x1920"),
+        # Whether the endpoint accepts n>1; otherwise images are requested concurrently
+        "supports_n": os.getenv("MODEL_1_SUPPORTS_N", "false").lower() == "true"
     },
     "model_2": {
         "name": os.getenv("MODEL_2_NAME", "Seedream 4.0"),
         "endpoint": os.getenv("MODEL_2_ENDPOINT"),
-        "size": os.getenv("MODEL_2_SIZE", "1024x1024")
+        "size": os.getenv("MODEL_2_SIZE", "1024x1024"),
+        "supports_n": os.getenv("MODEL_2_SUPPORTS_N", "false").lower() == "true"
     }
 }
 
@@ -213,6 +267,76 @@ if TEXT_API_KEY and TEXT_MODEL_ENDPOINT:
         base_url=TEXT_BASE_URL
     )
 
+def elapsed_ms(start_time):
+    """Milliseconds since start_time (a time.time() value), for event stage latencies."""
+    return round((time.time() - start_time) * 1000, 1)
+
+def find_similar_images(subject_prompt, limit=5):
+    """
+    Up to `limit` gallery images whose subject (the user's prompt without magic
+    word or style suffix) is a near-duplicate of this one, most similar first.
+    """
+    # Pick up images saved or evicted by other Gunicorn workers
+    prompt_index.sync(storage_manager)
+
+    results = []
+    for filename, similarity in prompt_index.lookup(subject_prompt, min_similarity=SIMILAR_MIN_SIMILARITY,
+                                                        limit=limit):
+        # Never suggest (or reuse) an image that has been evicted in the meantime
+        filename = storage_manager.resolve_filename(filename)
+        if not filename:
+            continue
+        metadata = storage_manager.load_metadata(filename)
+        results.append({
+            "image_url": storage_manager.get_image_url(filename),
+            "final_prompt": metadata.get("final_prompt"),
+            "model_id": metadata.get("model_id"),
+            "style_id": metadata.get("style_id"),
+            "raw_mode": metadata.get("raw_mode", False),
+            "similarity": round(similarity, 2)
+        })
+    return results
+
+def request_images(selected_model, final_prompt, num_images):
+    """
+    Ask the image API for num_images images.
+    Uses a single call with n=num_images when the model supports it,
+    otherwise num_images concurrent single-image calls.
+    Returns (temporary image URLs, exceptions from the calls that failed).
+    """
+    def call(n):
+        extra_args = {"n": n} if n > 1 else {}
+        response = client.images.generate(
+            model=selected_model["endpoint"],
+            prompt=final_prompt,
+            size=selected_model["size"],
+            **extra_args
+        )
+        return [item.url for item in (response.data or [])]
+
+    if num_images == 1 or selected_model.get("supports_n"):
+        return call(num_images)[:num_images], []
+
+    with ThreadPoolExecutor(max_workers=num_images) as executor:
+        futures = [executor.submit(call, 1) for _ in range(num_images)]
+
+    # Keep whatever succeeded; only fail if every call failed
+    image_urls, errors = [], []
+    for future in futures:
+        try:
+            image_urls.extend(future.result())
+        except Exception as e:
+            print(f"Image request failed: {e}")
+            errors.append(e)
+    if not image_urls and errors:
+        raise errors[0]
+    return image_urls, errors
+
+def save_images(image_urls, metadata):
+    """Save several generated images concurrently. Returns local URLs (None where saving failed)."""
+    with ThreadPoolExecutor(max_workers=len(image_urls)) as executor:
+        return list(executor.map(lambda url: storage_manager.save_image(url, metadata=dict(metadata)), image_urls))
+
 def enhance_prompt(user_prompt, style_suffix):
     """
     Use LLM to rewrite and enhance the prompt.
@@ -327,7 +451,8 @@ def get_config():
         ],
         "styles": [
             {"id": k, "name": v["name"], "group": v.get("group", "Other")} for k, v in STYLES.items()
-        ]
+        ],
+        "max_images": MAX_IMAGES_PER_REQUEST
     })
 
 @app.route('/generate', methods=['POST'])
@@ -350,12 +475,18 @@ def generate_image():
     if not user_prompt:
         return jsonify({"error": "No prompt provided"}), 400
 
+    # Only real integers: reject booleans (JSON true) and fractions like 2.9
+    num_images = data.get('num_images', 1)
+    if isinstance(num_images, bool) or not isinstance(num_images, int) \
+            or not 1 <= num_images <= MAX_IMAGES_PER_REQUEST:
+        return jsonify({"error": f"num_images must be between 1 and {MAX_IMAGES_PER_REQUEST}"}), 400
+
     # 2. Input Validation (Length Check)
     if len(user_prompt) > MAX_PROMPT_LENGTH:
         return jsonify({"error": f"Prompt too long ({len(user_prompt)} chars). Max allowed: {MAX_PROMPT_LENGTH}"}), 400
 
-    # 3. Rate Limit Check (Per Model)
-    allowed, message = check_rate_limit(model_id)
+    # 3. Rate Limit Check (Per Model, per image)
+    allowed, message = check_rate_limit(model_id, num_images)
     if not allowed:
         return jsonify({"error": message}), 429
 
@@ -366,9 +497,21 @@ def generate_image():
 
     # 4. Prompt Processing Pipeline
     start_time = time.time()
+    event = {
+        "request_id": str(uuid.uuid4()),
+        "model": model_id,
+        "style": style_id,
+        "stages": {},
+        "upstream_status": None,
+        "bytes_saved": 0,
+        "images": 0,
+        "cache": "none"
+    }
     # Magic word to skip enhancement
     MAGIC_WORD = "#原图"
     is_raw_mode = MAGIC_WORD in user_prompt
+    # What the user asked for, without the magic word or any style suffix (used for similarity)
+    subject_prompt = user_prompt.replace(MAGIC_WORD, "").strip()
     
     if is_raw_mode:
         # Raw Mode: Skip enhancement and style templates
@@ -390,47 +533,120 @@ def generate_image():
             enhanced = False if style_id == "none" else True
 
     print(f"Final Prompt: {final_prompt}")
+    event["stages"]["enhance"] = elapsed_ms(start_time)
 
     # Calculate simple token estimate (approx 4 chars per token)
     estimated_prompt_tokens = len(final_prompt) // 4
 
+    # 5. Near-Duplicate Check (suggest or reuse existing gallery images)
+    lookup_start = time.time()
+    # Enough candidates to reuse a full set of num_images
+    similar_images = find_similar_images(subject_prompt, limit=max(5, num_images))
+    event["stages"]["similar_lookup"] = elapsed_ms(lookup_start)
+    event["cache"] = "miss"
+
+    if data.get('reuse_similar'):
+        # Same subject is not enough: model, style and raw mode must match too
+        reusable = [img for img in similar_images
+                    if img["model_id"] == model_id and img["style_id"] == style_id
+                    and img["raw_mode"] == is_raw_mode and img["similarity"] >= REUSE_MIN_SIMILARITY]
+        # Reuse only if there are enough matches; otherwise generate them all
+        if len(reusable) >= num_images:
+            reusable = reusable[:num_images]
+            print(f"Reusing similar image(s): {[img['image_url'] for img in reusable]}")
+            event["cache"] = "hit"
+            event["images"] = len(reusable)
+            event["stages"]["total"] = elapsed_ms(start_time)
+            event["status"] = "ok"
+            event_log.record(event)
+
+            return jsonify({
+                "image_url": reusable[0]["image_url"],
+                "images": [{"image_url": img["image_url"]} for img in reusable],
+                "images_requested": num_images,
+                "original_prompt": user_prompt,
+                "final_prompt": final_prompt,
+                "model_used": selected_model["name"],
+                "style_used": STYLES.get(style_id, {}).get("name", "Unknown"),
+                "reused": True,
+                "similar_images": similar_images,
+                "debug_info": {
+                    "time_elapsed": f"{round(time.time() - start_time, 2)}s",
+                    "prompt_length": len(final_prompt),
+                    "estimated_tokens": estimated_prompt_tokens
+                }
+            })
+
     try:
-        print(f"Generating with Model: {selected_model['name']} ({selected_model['endpoint']})")
+        print(f"Generating {num_images} image(s) with Model: {selected_model['name']} ({selected_model['endpoint']})")
         print(f"Size: {selected_model['size']}")
 
         # Step 2: Call the Image Generation API via OpenAI SDK
-        response = client.images.generate(
-            model=selected_model["endpoint"],
-            prompt=final_prompt,
-            size=selected_model["size"], 
-        )
+        upstream_start = time.time()
+        image_urls, failed_calls = request_images(selected_model, final_prompt, num_images)
+        event["stages"]["upstream"] = elapsed_ms(upstream_start)
+        event["upstream_status"] = 200
+
+        warning = None
+        if failed_calls:
+            event["failed_calls"] = len(failed_calls)
+            event["error"] = str(failed_calls[0])
+        if image_urls and len(image_urls) < num_images:
+            warning = f"Only {len(image_urls)} of {num_images} images were generated."
+            if failed_calls:
+                warning += f" {len(failed_calls)} request(s) failed: {failed_calls[0]}"
         
-        # Increment counter only on success
-        increment_rate_limit(model_id)
+        # Increment counter only on success, once per image returned
+        increment_rate_limit(model_id, len(image_urls))
         
         end_time = time.time()
         elapsed_time = round(end_time - start_time, 2)
         
-        # Extract image URL
-        if response.data and len(response.data) > 0:
-            image_url = response.data[0].url
-            
-            # Save image locally for persistence
-            local_image_url = storage_manager.save_image(image_url)
+        if image_urls:
+            # Save images locally for persistence (concurrently)
+            save_start = time.time()
+            local_image_urls = save_images(image_urls, metadata={
+                "original_prompt": user_prompt,
+                "subject_prompt": subject_prompt,
+                "final_prompt": final_prompt,
+                "model_id": model_id,
+                "model_name": selected_model["name"],
+                "style_id": style_id,
+                "raw_mode": is_raw_mode,
+                "created_at": datetime.now().isoformat(timespec='seconds')
+            })
+            event["stages"]["save"] = elapsed_ms(save_start)
             
-            if not local_image_url:
-                print("Warning: Failed to save image locally. Using temporary URL.")
-                local_image_url = image_url # Fallback to temp URL if save fails
+            images = []
+            for image_url, local_image_url in zip(image_urls, local_image_urls):
+                if not local_image_url:
+                    print("Warning: Failed to save image locally. Using temporary URL.")
+                    local_image_url = image_url # Fallback to temp URL if save fails
+                else:
+                    event["bytes_saved"] += storage_manager.get_file_size(local_image_url)
+                images.append({"image_url": local_image_url})
+
+            event["images"] = len(images)
+            event["stages"]["total"] = elapsed_ms(start_time)
+            # Fewer images than requested counts as an error in /admin/stats
+            event["status"] = "partial" if warning else "ok"
+            event_log.record(event)
 
             # Get style name for response
             style_name = STYLES.get(style_id, {}).get("name", "Unknown")
             
             return jsonify({
-                "image_url": local_image_url, 
+                "image_url": images[0]["image_url"], 
+                "images": images,
+                "images_requested": num_images,
+                "failed_calls": len(failed_calls),
+                "warning": warning,
                 "original_prompt": user_prompt,
                 "final_prompt": final_prompt,
                 "model_used": selected_model["name"],
                 "style_used": style_name,
+                "reused": False,
+                "similar_images": similar_images,
                 "debug_info": {
                     "time_elapsed": f"{elapsed_time}s",
                     "prompt_length": len(final_prompt),
@@ -438,11 +654,90 @@ def generate_image():
                 }
             })
         else:
+            event["stages"]["total"] = elapsed_ms(start_time)
+            event["status"] = "error"
+            event["error"] = "No image data returned from API"
+            event_log.record(event)
             return jsonify({"error": "No image data returned from API"}), 500
 
     except Exception as e:
         print(f"Error generating image: {e}")
+        event["stages"]["total"] = elapsed_ms(start_time)
+        event["upstream_status"] = event["upstream_status"] or getattr(e, "status_code", None) or "error"
+        event["status"] = "error"
+        event["error"] = str(e)
+        event_log.record(event)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/export', methods=['GET'])
+def export_gallery():
+    """
+    Stream a zip/tar of gallery images plus a manifest.json.
+    Query params: format (zip|tar), start/end (YYYY-MM-DD), model, style.
+    The access code goes in the X-Access-Code header, never in the URL
+    (the Gunicorn access log records full request lines).
+    """
+    if ACCESS_CODE:
+        user_code = request.headers.get('X-Access-Code')
+        if user_code != ACCESS_CODE:
+            return jsonify({"error": "Invalid Access Code"}), 401
+
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unsupported format '{archive_format}'. Use zip or tar."}), 400
+
+    try:
+        start_date = request.args.get('start')
+        end_date = request.args.get('end')
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else None
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else None
+    except ValueError:
+        return jsonify({"error": "Invalid date. Use YYYY-MM-DD."}), 400
+
+    images = storage_manager.list_images(
+        start_date=start_date,
+        end_date=end_date,
+        model=request.args.get('model'),
+        style=request.args.get('style')
+    )
+
+    filename = f"gallery_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{archive_format}"
+    # No Content-Length: the archive is built on the fly and sent chunked
+    return Response(
+        stream_with_context(stream_archive(images, archive_format, storage_manager)),
+        mimetype=EXPORT_FORMATS[archive_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.route('/admin/stats', methods=['GET'])
+def admin_stats():
+    """
+    Aggregated generation stats: requests per model per day, stage latencies, error rates.
+    The access code goes in the X-Access-Code header, like /export.
+    """
+    if ACCESS_CODE:
+        user_code = request.headers.get('X-Access-Code')
+        if user_code != ACCESS_CODE:
+            return jsonify({"error": "Invalid Access Code"}), 401
+
+    stats = event_log.stats()
+    stats["recompression"] = recompressor.stats()
+    return jsonify(stats)
+
+@app.errorhandler(404)
+def not_found(e):
+    """Old gallery URLs keep working after an image is re-encoded to another format."""
+    gallery_prefix = f"/{storage_manager.base_dir}/"
+    if request.path.startswith(gallery_prefix):
+        name = request.path[len(gallery_prefix):]
+        # Plain file names only: no probing for files outside the gallery (../, subfolders)
+        if name != os.path.basename(name) or name in ('', '.', '..'):
+            return e
+        filename = storage_manager.resolve_filename(name)
+        if filename:
+            return redirect(storage_manager.get_image_url(filename), code=301)
+    return e
+
 if __name__ == '__main__':
+    start_background_jobs()
     app.run(debug=True)
@@ -0,0 +1,74 @@
+import random
+import time
+from similarity import PromptIndex, _features
+
+# Benchmark PromptIndex lookups at gallery scale.
+# Usage: python bench_similarity.py
+
+NUM_ENTRIES = 100_000
+NUM_LOOKUPS = 1_000
+
+# Synthetic prompts: random words from a ~1000-word vocabulary, roughly the shape of
+# what users type (the index never sees style suffixes).
+VOCABULARY = [f"word{i}" for i in range(1000)]
+
+
+def random_prompt(rng):
+    return " ".join(rng.sample(VOCABULARY, rng.randint(8, 30)))
+
+
+def edit_prompt(rng, prompt):
+    """Near-duplicate of prompt: different casing/punctuation and one word swapped."""
+    words = prompt.upper().replace(",", "").split()
+    words[rng.randrange(len(words))] = rng.choice(VOCABULARY).upper()
+    return " ".join(words) + "!"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    prompts = [random_prompt(rng) for _ in range(NUM_ENTRIES)]
+    index = PromptIndex()
+
+    print(f"🏗️  Indexing {NUM_ENTRIES} prompts...")
+    start = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        index.add(f"{i:08d}.png", prompt)
+    elapsed = time.perf_counter() - start
+    print(f"   {elapsed:.2f}s total, {elapsed / NUM_ENTRIES * 1e6:.0f}µs per add")
+
+    print(f"\n🔎 Running {NUM_LOOKUPS} lookups (near-duplicates of indexed prompts)...")
+    timings = []
+    hits = 0
+    expected = 0
+    expected_hits = 0
+    for _ in range(NUM_LOOKUPS):
+        source = rng.randrange(NUM_ENTRIES)
+        query = edit_prompt(rng, prompts[source])
+        start = time.perf_counter()
+        matches = index.lookup(query)
+        timings.append((time.perf_counter() - start) * 1000)
+        # Recall: the prompt the query was derived from must be among the matches
+        found = f"{source:08d}.png" in [filename for filename, _ in matches]
+        hits += found
+        # Queries whose true Jaccard similarity clears the default threshold should always be found
+        a, b = _features(query), _features(prompts[source])
+        if len(a & b) / len(a | b) >= 0.7:
+            expected += 1
+            expected_hits += found
+
+    print(f"   p50: {percentile(timings, 0.50):.2f}ms  p95: {percentile(timings, 0.95):.2f}ms  "
+          f"p99: {percentile(timings, 0.99):.2f}ms  max: {max(timings):.2f}ms")
+    print(f"   Recall: found the source prompt for {hits}/{NUM_LOOKUPS} queries ({hits / NUM_LOOKUPS:.1%})")
+    print(f"   Of the {expected} with true Jaccard >= 0.7, found {expected_hits} ({expected_hits / expected:.1%})")
+
+    print("\n🗑️  Removing every other entry...")
+    start = time.perf_counter()
+    for i in range(0, NUM_ENTRIES, 2):
+        index.remove(f"{i:08d}.png")
+    elapsed = time.perf_counter() - start
+    print(f"   {elapsed / (NUM_ENTRIES // 2) * 1e6:.0f}µs per remove, {len(index)} entries left")
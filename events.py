@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import queue
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads within this process are serialized
+    fcntl = None
+
+# Latency histogram bucket upper bounds in ms (geometric, 1ms .. ~10min).
+# Percentiles are read from the buckets, so they are accurate to ~20%.
+LATENCY_BUCKETS_MS = [round(1.2 ** i, 1) for i in range(75)]
+
+
+class EventLog:
+    """
+    Append-only JSONL log of generation events.
+
+    record() only enqueues the event; a background thread batches writes,
+    rotates the file by size and folds each batch into summary.json, which
+    /admin/stats reads without rescanning the log.
+
+    Gunicorn workers share the log directory: appends, rotation and summary
+    updates happen under a file lock, so every worker's events are counted
+    once and every worker reports the same totals.
+    """
+    def __init__(self, log_dir='logs', max_bytes=10 * 1024 * 1024, backup_count=5,
+                 batch_size=200, flush_interval=2.0):
+        self.log_dir = log_dir
+        self.log_path = os.path.join(log_dir, 'events.jsonl')
+        self.summary_path = os.path.join(log_dir, 'summary.json')
+        self.lock_path = os.path.join(log_dir, '.events.lock')
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=10000)
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._writer_loop, name='event-log-writer', daemon=True)
+        self._thread.start()
+
+    def record(self, event):
+        """Queue an event for writing. Never blocks the request thread."""
+        event.setdefault("ts", datetime.now().isoformat(timespec='milliseconds'))
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            print("Event log queue full, dropping event")
+
+    def flush(self):
+        """Block until every event recorded so far is written and summarized."""
+        self._queue.join()
+
+    def stats(self):
+        """Aggregated view of the summary: volume, latency percentiles, error rates."""
+        with self._locked():
+            summary = self._load_summary()
+
+        return {
+            "requests_per_model_per_day": summary["requests"],
+            "latency_ms": {
+                stage: {
+                    "count": sum(hist),
+                    "p50": _percentile(hist, 0.50),
+                    "p95": _percentile(hist, 0.95)
+                }
+                for stage, hist in summary["stages"].items()
+            },
+            "error_rates": {
+                model: {
+                    "total": counts["total"],
+                    "errors": counts["errors"],
+                    "error_rate": round(counts["errors"] / counts["total"], 4) if counts["total"] else 0.0
+                }
+                for model, counts in summary["outcomes"].items()
+            },
+            "upstream_status": summary["upstream_status"],
+            "cache": summary["cache"],
+            "bytes_saved": summary["bytes_saved"]
+        }
+
+    # === Writer thread ===
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                print(f"Error writing event log: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch):
+        data = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in batch)
+        with self._locked():
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                size = f.tell()
+
+            # Merge this batch into the shared summary (other workers merge theirs)
+            summary = self._load_summary()
+            for event in batch:
+                _apply(summary, event)
+            self._save_summary(summary)
+
+            if size >= self.max_bytes:
+                self._rotate()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access to the log files across threads and worker processes."""
+        with self._lock:
+            with open(self.lock_path, 'w') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def _rotate(self):
+        """events.jsonl -> events.jsonl.1 -> ... -> events.jsonl.<backup_count> (caller holds the lock)"""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.log_path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.log_path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.log_path, f"{self.log_path}.1")
+        else:
+            os.remove(self.log_path)
+
+    # === Summary ===
+
+    def _load_summary(self):
+        summary = {
+            "requests": {},
+            "outcomes": {},
+            "stages": {},
+            "upstream_status": {},
+            "cache": {},
+            "bytes_saved": 0
+        }
+        try:
+            with open(self.summary_path, 'r', encoding='utf-8') as f:
+                summary.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return summary
+
+    def _save_summary(self, summary):
+        # Write to a temp file first so a crash never leaves a half-written summary
+        tmp_path = f"{self.summary_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f)
+        os.replace(tmp_path, self.summary_path)
+
+
+def _apply(summary, event):
+    """Fold one event into the summary."""
+    model = event.get("model") or "unknown"
+    day = event["ts"][:10]
+
+    per_day = summary["requests"].setdefault(day, {})
+    per_day[model] = per_day.get(model, 0) + 1
+
+    outcomes = summary["outcomes"].setdefault(model, {"total": 0, "errors": 0})
+    outcomes["total"] += 1
+    if event.get("status") != "ok":
+        outcomes["errors"] += 1
+
+    for stage, ms in (event.get("stages") or {}).items():
+        hist = summary["stages"].setdefault(stage, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+        hist[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    upstream = str(event.get("upstream_status"))
+    summary["upstream_status"][upstream] = summary["upstream_status"].get(upstream, 0) + 1
+
+    cache = event.get("cache") or "none"
+    summary["cache"][cache] = summary["cache"].get(cache, 0) + 1
+
+    summary["bytes_saved"] += event.get("bytes_saved") or 0
+
+
+def _percentile(hist, q):
+    """Upper bound (ms) of the histogram bucket containing the q-th percentile."""
+    total = sum(hist)
+    if not total:
+        return None
+    target = q * total
+    cumulative = 0
+    for i, count in enumerate(hist):
+        cumulative += count
+        if cumulative >= target:
+            return LATENCY_BUCKETS_MS[min(i, len(LATENCY_BUCKETS_MS) - 1)]
+    return None
@@ -0,0 +1,184 @@
+import io
+import os
+import json
+import tarfile
+import time
+import zipfile
+from datetime import datetime
+
+# Size of each read from disk / each chunk sent to the client.
+CHUNK_SIZE = 256 * 1024
+
+EXPORT_FORMATS = {
+    "zip": "application/zip",
+    "tar": "application/x-tar"
+}
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only, unseekable file object that collects whatever the archive
+    writer produces so the generator can hand it straight to the client.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def build_manifest(images, skipped=()):
+    """
+    Builds the manifest.json payload describing every exported image,
+    plus the names of planned images that were evicted before they were read.
+    """
+    return json.dumps({
+        "exported_at": datetime.now().isoformat(timespec='seconds'),
+        "count": len(images),
+        "total_bytes": sum(img["size"] for img in images),
+        "images": [
+            {
+                "filename": img["filename"],
+                "size": img["size"],
+                "created_at": img["created_at"].isoformat(),
+                **img["metadata"]
+            }
+            for img in images
+        ],
+        "skipped": list(skipped)
+    }, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _open_image(img, storage_manager):
+    """
+    Opens an image for export. Returns (file, entry), where entry points at the
+    re-encoded file if the image was renamed meanwhile (e.g. x.png -> x.webp),
+    or (None, entry) if it was evicted.
+    """
+    try:
+        return open(img["path"], 'rb', buffering=0), img
+    except FileNotFoundError:
+        pass
+
+    filename = storage_manager.resolve_filename(img["filename"])
+    if filename:
+        path = os.path.join(storage_manager.base_dir, filename)
+        try:
+            src = open(path, 'rb', buffering=0)
+        except FileNotFoundError:
+            pass
+        else:
+            return src, dict(img, filename=filename, path=path, size=os.fstat(src.fileno()).st_size,
+                             metadata=storage_manager.load_metadata(filename) or img["metadata"])
+
+    print(f"Export: skipping evicted image {img['filename']}")
+    return None, img
+
+
+def _read_chunks(f, size):
+    """
+    Yields the file contents in CHUNK_SIZE pieces, reusing a single buffer.
+    Stops at the size seen when the export was planned, so the archive
+    headers stay consistent even if the file changes underneath us.
+    """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    remaining = size
+    while remaining > 0:
+        n = f.readinto(view[:min(CHUNK_SIZE, remaining)])
+        if not n:
+            raise IOError(f"{f.name} was truncated during export")
+        remaining -= n
+        yield view[:n]
+
+
+def stream_zip(images, storage_manager):
+    """
+    Generates a ZIP archive (images + manifest.json) chunk by chunk.
+    Images are stored, not deflated: PNG/JPEG data is already compressed.
+    The manifest goes last so it lists exactly what ended up in the archive.
+    """
+    sink = _ChunkSink()
+    exported, skipped = [], []
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for img in images:
+            src, img = _open_image(img, storage_manager)
+            if src is None:
+                skipped.append(img["filename"])
+                continue
+
+            info = zipfile.ZipInfo(img["filename"], date_time=img["created_at"].timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = img["size"]
+            with src, zf.open(info, mode='w', force_zip64=img["size"] >= zipfile.ZIP64_LIMIT) as dest:
+                for chunk in _read_chunks(src, img["size"]):
+                    dest.write(chunk)
+                    yield sink.drain()
+            exported.append(img)
+            yield sink.drain()
+
+        zf.writestr("manifest.json", build_manifest(exported, skipped))
+        yield sink.drain()
+    # Central directory is written on close
+    yield sink.drain()
+
+
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _tar_padding(size):
+    remainder = size % tarfile.BLOCKSIZE
+    return b"\0" * (tarfile.BLOCKSIZE - remainder) if remainder else b""
+
+
+def stream_tar(images, storage_manager):
+    """
+    Generates an uncompressed TAR archive (images + manifest.json) chunk by chunk.
+    Headers are written by hand so each file is streamed straight from disk.
+    The manifest goes last so it lists exactly what ended up in the archive.
+    """
+    exported, skipped = [], []
+    for img in images:
+        src, img = _open_image(img, storage_manager)
+        if src is None:
+            skipped.append(img["filename"])
+            continue
+
+        with src:
+            yield _tar_header(img["filename"], img["size"], img["created_at"].timestamp())
+            for chunk in _read_chunks(src, img["size"]):
+                yield bytes(chunk)
+            yield _tar_padding(img["size"])
+        exported.append(img)
+
+    manifest = build_manifest(exported, skipped)
+    yield _tar_header("manifest.json", len(manifest), time.time())
+    yield manifest + _tar_padding(len(manifest))
+
+    # End-of-archive marker: two empty blocks
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+def stream_archive(images, archive_format, storage_manager):
+    """Yields the archive in the requested format, skipping empty chunks."""
+    if archive_format == "tar":
+        generator = stream_tar(images, storage_manager)
+    else:
+        generator = stream_zip(images, storage_manager)
+    for chunk in generator:
+        if chunk:
+            yield chunk
@@ -16,3 +16,8 @@ timeout = 120
 accesslog = "-"  # Log to stdout
 errorlog = "-"   # Log to stderr
 loglevel = "info"
+
+# Start background jobs (gallery recompression) once each worker has loaded the app
+def post_worker_init(worker):
+    from app import start_background_jobs
+    start_background_jobs()
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional: without it the job simply doesn't run
+    Image = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, every process may run passes
+    fcntl = None
+
+
+class GalleryRecompressor:
+    """
+    Low-priority background job that re-encodes gallery images once they
+    leave the hot window, to optimized PNG (lossless) or WebP.
+
+    The job runs on a niced thread and sleeps between images to stay within
+    its CPU and I/O budgets, so it does not compete with request handling.
+    A lock file makes sure only one Gunicorn worker runs a pass at a time,
+    and totals are kept in a stats file so every worker can report them.
+    The lock, stats and temporary files live in state_dir, which must not be
+    publicly served and must be on the same filesystem as the gallery
+    (so the final os.replace is atomic).
+    """
+    def __init__(self, storage_manager, state_dir='logs/recompress', target_format='webp', webp_quality=90,
+                 hot_window_hours=24, cpu_budget=0.1, io_budget_bytes=5 * 1024 * 1024,
+                 interval=600, max_attempts=3):
+        self.storage_manager = storage_manager
+        self.target_format = target_format.lower()
+        self.webp_quality = webp_quality
+        self.hot_window = timedelta(hours=hot_window_hours)
+        self.cpu_budget = cpu_budget              # Fraction of one core (0-1)
+        self.io_budget_bytes = io_budget_bytes    # Bytes read + written per second
+        self.interval = interval                  # Seconds between passes
+        self.max_attempts = max_attempts          # Failed encodes before an image is left alone
+
+        self.state_dir = state_dir
+        self._tmp_dir = os.path.join(state_dir, 'tmp')
+        self._lock_path = os.path.join(state_dir, 'recompress.lock')
+        self._stats_path = os.path.join(state_dir, 'recompress_stats.json')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._move_public_state()
+        self._stats = self._load_stats()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background thread. Does nothing if Pillow is not installed.
+        Not called on import: the server starts it explicitly (see start_background_jobs in app.py).
+        """
+        if Image is None:
+            print("Recompression disabled: Pillow is not installed")
+            return
+        if self._thread is not None:
+            return
+        if os.stat(self._tmp_dir).st_dev != os.stat(self.storage_manager.base_dir).st_dev:
+            print(f"Recompression disabled: {self.state_dir} is not on the same filesystem as the gallery")
+            return
+        self._thread = threading.Thread(target=self._run_forever, name='gallery-recompressor', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        """Running totals, including bytes reclaimed, across all passes and workers."""
+        return self._load_stats()
+
+    def _run_forever(self):
+        # Lowest CPU priority for this thread only (Linux applies nice values per thread)
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Recompression pass failed: {e}")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        """
+        Re-encode every image older than the hot window that hasn't been processed
+        yet, skipping images that already failed max_attempts times.
+        """
+        with open(self._lock_path, 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return # Another worker is already running a pass
+
+            # Another worker may have run the previous pass
+            self._stats = self._load_stats()
+
+            cutoff = datetime.now() - self.hot_window
+            for image in self.storage_manager.list_images(end_date=cutoff.date()):
+                metadata = image["metadata"]
+                if image["created_at"] > cutoff or metadata.get("recompressed") \
+                        or metadata.get("recompress_failures", 0) >= self.max_attempts:
+                    continue
+                self._recompress(image)
+
+            self._stats["last_pass"] = datetime.now().isoformat(timespec='seconds')
+            self._save_stats()
+
+    def _recompress(self, image):
+        filename = image["filename"]
+        stem, ext = os.path.splitext(filename)
+        new_ext = '.webp' if self.target_format == 'webp' else '.png'
+        new_filename = stem + new_ext
+        tmp_path = os.path.join(self._tmp_dir, f"{stem}.{uuid.uuid4().hex[:8]}.tmp")
+
+        cpu_start = time.thread_time()
+        io_bytes = image["size"]
+        try:
+            with Image.open(image["path"]) as img:
+                if self.target_format == 'webp':
+                    img.save(tmp_path, 'WEBP', quality=self.webp_quality, lossless=self.webp_quality >= 100, method=6)
+                else:
+                    img.save(tmp_path, 'PNG', optimize=True)
+            new_size = os.path.getsize(tmp_path)
+            io_bytes += new_size
+
+            metadata = dict(image["metadata"])
+            metadata["recompressed"] = True
+            if new_size < image["size"]:
+                metadata["original_format"] = ext.lstrip('.')
+                metadata["original_bytes"] = image["size"]
+                self.storage_manager.replace_image(filename, new_filename, tmp_path, metadata)
+                self._stats["images_recompressed"] += 1
+                self._stats["bytes_reclaimed"] += image["size"] - new_size
+                print(f"Recompressed {filename} -> {new_filename}: {image['size']} -> {new_size} bytes")
+            else:
+                # Already as small as we can make it; remember that and move on
+                os.remove(tmp_path)
+                self.storage_manager.update_metadata(filename, metadata)
+                self._stats["images_skipped"] += 1
+
+        except FileNotFoundError:
+            pass # Evicted while we were working on it
+        except Exception as e:
+            print(f"Error recompressing {filename}: {e}")
+            self._stats["errors"] += 1
+            # Remember the failure so a corrupt or unsupported image isn't decoded every pass
+            metadata = dict(image["metadata"])
+            metadata["recompress_failures"] = metadata.get("recompress_failures", 0) + 1
+            metadata["recompress_error"] = str(e)
+            self.storage_manager.update_metadata(filename, metadata)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._save_stats()
+            self._throttle(time.thread_time() - cpu_start, io_bytes)
+
+    def _move_public_state(self):
+        """Older versions kept job state in the (publicly served) gallery folder; move it out."""
+        base_dir = self.storage_manager.base_dir
+        try:
+            old_stats = os.path.join(base_dir, '.recompress_stats.json')
+            if os.path.exists(old_stats):
+                os.replace(old_stats, self._stats_path)
+            for filename in os.listdir(base_dir):
+                if filename == '.recompress.lock' or (filename.startswith('.') and filename.endswith('.tmp')):
+                    os.remove(os.path.join(base_dir, filename))
+        except Exception as e:
+            print(f"Error moving recompression state out of {base_dir}: {e}")
+
+    def _load_stats(self):
+        stats = {
+            "images_recompressed": 0,
+            "images_skipped": 0,
+            "errors": 0,
+            "bytes_reclaimed": 0,
+            "last_pass": None
+        }
+        try:
+            with open(self._stats_path, 'r', encoding='utf-8') as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def _save_stats(self):
+        tmp_path = f"{self._stats_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._stats, f)
+        os.replace(tmp_path, self._stats_path)
+
+    def _throttle(self, cpu_seconds, io_bytes):
+        """Sleep long enough to keep CPU and I/O use within budget."""
+        cpu_sleep = cpu_seconds * (1 / self.cpu_budget - 1) if self.cpu_budget > 0 else 0
+        io_sleep = io_bytes / self.io_budget_bytes if self.io_budget_bytes > 0 else 0
+        time.sleep(max(cpu_sleep, io_sleep))
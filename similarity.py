@@ -0,0 +1,165 @@
+import re
+import struct
+import hashlib
+import threading
+from functools import lru_cache
+
+# MinHash signature: NUM_PERM 32-bit values, split into BANDS bands of ROWS values for LSH
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+_SIGNATURE_FORMAT = f"<{NUM_PERM}I"
+_BAND_BYTES = ROWS * 4
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+
+def normalize_prompt(prompt):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return " ".join(_PUNCTUATION_RE.sub(" ", prompt.lower()).split())
+
+
+def _features(prompt):
+    """Word unigrams plus bigrams, so word order still counts a little."""
+    words = normalize_prompt(prompt).split()
+    return set(words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+
+
+@lru_cache(maxsize=8192)
+def _feature_digest(feature):
+    """Bytes for NUM_PERM independent 32-bit hashes of one feature (two 64-byte BLAKE2b digests)."""
+    data = feature.encode('utf-8')
+    return (hashlib.blake2b(data, digest_size=64).digest()
+            + hashlib.blake2b(data, digest_size=64, salt=b'minhash').digest())
+
+
+def minhash(prompt):
+    """MinHash signature of a prompt, packed as bytes (NUM_PERM little-endian uint32s)."""
+    rows = [struct.unpack(_SIGNATURE_FORMAT, _feature_digest(feature)) for feature in _features(prompt)]
+    if not rows:
+        return bytes(NUM_PERM * 4)
+    return struct.pack(_SIGNATURE_FORMAT, *map(min, zip(*rows)))
+
+
+def estimate_similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of the two prompts' word sets (0.0 - 1.0)."""
+    a = struct.unpack(_SIGNATURE_FORMAT, sig_a)
+    b = struct.unpack(_SIGNATURE_FORMAT, sig_b)
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class PromptIndex:
+    """
+    Near-duplicate index over gallery images' prompts (MinHash + LSH).
+
+    Only the user's own words are indexed, not the final prompt: style
+    suffixes are long and shared, so they would make different subjects in
+    the same style look alike ("a cat" vs "a dog" with the Ghibli suffix
+    scores ~0.9). Callers compare style and model separately.
+
+    Each signature is cut into BANDS bands of ROWS values. Prompts that share
+    any whole band land in the same bucket and become candidates. Only the
+    candidates are scored, so lookups stay fast as the gallery grows.
+    Prompts with ~85% word overlap are almost always found.
+
+    The index lives in each process. Saves and evictions made by this process
+    update it directly; call sync() before a lookup to pick up changes made
+    by other Gunicorn workers, which only rescans when the gallery changed.
+    """
+    def __init__(self):
+        self._signatures = {}  # filename -> signature bytes
+        self._buckets = [{} for _ in range(BANDS)]  # band bytes -> set of filenames
+        self._lock = threading.Lock()
+        self._sync_token = None
+
+    def __len__(self):
+        return len(self._signatures)
+
+    @staticmethod
+    def indexed_prompt(metadata):
+        """The prompt an image is indexed by: the user's prompt without magic words or style suffix."""
+        # Images saved before subject_prompt was recorded fall back to what the user typed
+        return metadata.get("subject_prompt") or metadata.get("original_prompt")
+
+    def add(self, filename, prompt):
+        """Index (or re-index) a gallery image by its indexed prompt (see indexed_prompt)."""
+        signature = minhash(prompt)
+        with self._lock:
+            self._remove_locked(filename)
+            self._signatures[filename] = signature
+            for bucket, key in zip(self._buckets, _band_keys(signature)):
+                bucket.setdefault(key, set()).add(filename)
+
+    def remove(self, filename):
+        with self._lock:
+            self._remove_locked(filename)
+
+    def rename(self, old_filename, new_filename):
+        """Point an indexed image at its new file name (e.g. after re-encoding)."""
+        with self._lock:
+            signature = self._signatures.get(old_filename)
+            if signature is None:
+                return
+            self._remove_locked(old_filename)
+            self._signatures[new_filename] = signature
+            for bucket, key in zip(self._buckets, _band_keys(signature)):
+                bucket.setdefault(key, set()).add(new_filename)
+
+    def lookup(self, prompt, min_similarity=0.7, limit=5):
+        """Returns up to `limit` (filename, similarity) pairs, most similar first."""
+        signature = minhash(prompt)
+        with self._lock:
+            candidates = set()
+            for bucket, key in zip(self._buckets, _band_keys(signature)):
+                candidates.update(bucket.get(key, ()))
+            matches = []
+            for filename in candidates:
+                similarity = estimate_similarity(signature, self._signatures[filename])
+                if similarity >= min_similarity:
+                    matches.append((filename, similarity))
+
+        matches.sort(key=lambda m: (-m[1], m[0]))
+        return matches[:limit]
+
+    def build(self, storage_manager):
+        """Build the index from the metadata saved alongside gallery images."""
+        self._sync_token = None
+        self.sync(storage_manager)
+        print(f"Prompt index built with {len(self)} images")
+
+    def sync(self, storage_manager):
+        """
+        Bring the index in line with the gallery on disk: index new images and
+        drop evicted or renamed ones. Does nothing if the gallery is unchanged.
+        """
+        token = storage_manager.change_token()
+        if token is not None and token == self._sync_token:
+            return
+        # Taken before listing, so changes made while we scan trigger another sync
+        self._sync_token = token
+
+        present = set(storage_manager.list_filenames())
+        with self._lock:
+            indexed = set(self._signatures)
+
+        for filename in indexed - present:
+            self.remove(filename)
+        for filename in present - indexed:
+            prompt = self.indexed_prompt(storage_manager.load_metadata(filename))
+            if prompt:
+                self.add(filename, prompt)
+
+    def _remove_locked(self, filename):
+        signature = self._signatures.pop(filename, None)
+        if signature is None:
+            return
+        for bucket, key in zip(self._buckets, _band_keys(signature)):
+            entries = bucket.get(key)
+            if entries:
+                entries.discard(filename)
+                if not entries:
+                    del bucket[key]
+
+
+def _band_keys(signature):
+    return [signature[i:i + _BAND_BYTES] for i in range(0, len(signature), _BAND_BYTES)]
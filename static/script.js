@@ -8,13 +8,18 @@ document.addEventListener('DOMContentLoaded', () => {
     const customStyleContainer = document.getElementById('customStyleContainer');
     const customStyleInput = document.getElementById('customStyleInput');
     const surpriseBtn = document.getElementById('surpriseBtn');
+    const reuseSimilarCheckbox = document.getElementById('reuseSimilarCheckbox');
+    const numImagesSelect = document.getElementById('numImagesSelect');
     
     const loadingDiv = document.getElementById('loading');
     const resultSection = document.getElementById('resultSection');
     const generatedImage = document.getElementById('generatedImage');
+    const resultGrid = document.getElementById('resultGrid');
     const errorSection = document.getElementById('errorSection');
     const errorMessage = document.getElementById('errorMessage');
     const finalPromptDisplay = document.getElementById('finalPromptDisplay');
+    const similarSection = document.getElementById('similarSection');
+    const similarGrid = document.getElementById('similarGrid');
     const debugSection = document.getElementById('debugSection');
     const debugFinalPrompt = document.getElementById('debugFinalPrompt');
     const debugOriginalPrompt = document.getElementById('debugOriginalPrompt');
@@ -57,6 +62,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 });
             }
 
+            // Populate image counts up to the server's MAX_IMAGES_PER_REQUEST
+            numImagesSelect.innerHTML = '';
+            for (let n = 1; n <= (data.max_images || 1); n++) {
+                const option = document.createElement('option');
+                option.value = n;
+                option.textContent = n;
+                numImagesSelect.appendChild(option);
+            }
+
             // Store and populate Styles
             allStyles = data.styles || [];
             populateCategories(allStyles);
@@ -259,7 +273,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     prompt: prompt,
                     access_code: accessCode,
                     model_id: selectedModel,
-                    style_id: selectedStyle
+                    style_id: selectedStyle,
+                    reuse_similar: reuseSimilarCheckbox.checked,
+                    num_images: parseInt(numImagesSelect.value, 10)
                 }),
             });
 
@@ -270,19 +286,30 @@ document.addEventListener('DOMContentLoaded', () => {
             }
 
             // Success
-            generatedImage.src = data.image_url;
+            const images = data.images || [{ image_url: data.image_url }];
+            renderResultImages(images);
             finalPromptDisplay.innerHTML = `
                 <strong>Model:</strong> ${data.model_used}<br>
                 <strong>Style:</strong> ${data.style_used || 'Default'}<br>
+                ${data.reused ? '<strong>♻️ Reused an existing gallery image (no quota used)</strong><br>' : ''}
             `;
+            if (data.warning) {
+                const warningLine = document.createElement('strong');
+                warningLine.textContent = `⚠️ ${data.warning}`;
+                finalPromptDisplay.appendChild(warningLine);
+            }
+
+            renderSimilarImages(data.similar_images || [], images.map(img => img.image_url));
             
-            // Save to Gallery History
-            saveToHistory({
-                url: data.image_url,
-                prompt: data.original_prompt,
-                model: data.model_used,
-                style: data.style_used,
-                timestamp: new Date().toISOString()
+            // Save to Gallery History (oldest first so the first image ends up on top)
+            images.slice().reverse().forEach(img => {
+                saveToHistory({
+                    url: img.image_url,
+                    prompt: data.original_prompt,
+                    model: data.model_used,
+                    style: data.style_used,
+                    timestamp: new Date().toISOString()
+                });
             });
 
             // Populate Debug Info
@@ -308,6 +335,50 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Show the generated image, or a grid when several were generated
+    function renderResultImages(images) {
+        resultGrid.innerHTML = '';
+        if (images.length === 1) {
+            generatedImage.src = images[0].image_url;
+            generatedImage.classList.remove('hidden');
+            resultGrid.classList.add('hidden');
+            return;
+        }
+
+        generatedImage.classList.add('hidden');
+        images.forEach(img => {
+            const el = document.createElement('img');
+            el.src = img.image_url;
+            el.alt = 'Generated Image';
+            el.className = 'w-full h-auto cursor-pointer';
+            el.addEventListener('click', () => window.open(img.image_url, '_blank'));
+            resultGrid.appendChild(el);
+        });
+        resultGrid.classList.remove('hidden');
+    }
+
+    // Show near-duplicate gallery images returned by /generate
+    function renderSimilarImages(images, currentUrls) {
+        similarGrid.innerHTML = '';
+        const others = images.filter(img => !currentUrls.includes(img.image_url));
+        if (others.length === 0) {
+            similarSection.classList.add('hidden');
+            return;
+        }
+
+        others.forEach(img => {
+            const thumb = document.createElement('img');
+            thumb.src = img.image_url;
+            thumb.title = `${Math.round(img.similarity * 100)}% similar: ${img.final_prompt || ''}`;
+            thumb.className = 'w-full h-24 object-cover rounded cursor-pointer hover:opacity-90 transition';
+            thumb.addEventListener('click', () => {
+                openModal(img.image_url, img.final_prompt || '', '', img.style_id || '');
+            });
+            similarGrid.appendChild(thumb);
+        });
+        similarSection.classList.remove('hidden');
+    }
+
     // === Gallery Logic ===
 
     // Toggle Gallery View
@@ -325,8 +396,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // Save item to LocalStorage
     function saveToHistory(item) {
         const history = JSON.parse(localStorage.getItem('image_history') || '[]');
-        // Add ID
-        item.id = Date.now().toString();
+        // Add ID (unique even when several images are saved in the same millisecond)
+        item.id = Date.now().toString() + '_' + Math.random().toString(36).slice(2, 8);
         // Add to beginning
         history.unshift(item);
         // Limit to 50 items in local history (ECS keeps more, but browser keeps recent)
@@ -1,21 +1,34 @@
 import os
+import json
 import time
 import requests
 import uuid
 import socket
+import threading
 import ipaddress
 from urllib.parse import urlparse
 from datetime import datetime
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
 class StorageManager:
-    def __init__(self, storage_type='local', base_dir='static/gallery', max_files=2000):
+    def __init__(self, storage_type='local', base_dir='static/gallery', max_files=2000, prompt_index=None,
+                 metadata_dir='gallery_metadata'):
         self.storage_type = storage_type
         self.base_dir = base_dir
+        # Metadata holds users' prompts, so it must live outside the public static folder
+        self.metadata_dir = metadata_dir
         self.max_files = max_files
+        # Optional PromptIndex kept in sync with saves and evictions
+        self.prompt_index = prompt_index
+        # Images may be saved concurrently; only one cleanup runs at a time
+        self._cleanup_lock = threading.Lock()
         
         # Ensure the directory exists for local storage
         if self.storage_type == 'local':
             os.makedirs(self.base_dir, exist_ok=True)
+            os.makedirs(self.metadata_dir, exist_ok=True)
+            self._move_public_metadata()
 
     def save_image(self, image_url, metadata=None):
         """
@@ -52,12 +65,20 @@ class StorageManager:
                     for chunk in response.iter_content(chunk_size=8192):
                         f.write(chunk)
                 
+                # Persist generation details next to the image (used by export)
+                if metadata:
+                    self._write_metadata(filename, metadata)
+                    if self.prompt_index is not None:
+                        prompt = self.prompt_index.indexed_prompt(metadata)
+                        if prompt:
+                            self.prompt_index.add(filename, prompt)
+                
                 # Cleanup old images if needed
                 self._cleanup_local_storage()
                 
                 # Return the relative path for frontend use
                 # Note: This assumes the base_dir is inside 'static/'
-                return f"/{self.base_dir}/{filename}"
+                return self.get_image_url(filename)
             
             elif self.storage_type == 'tos':
                 # TODO: Implement TOS upload logic here
@@ -69,6 +90,158 @@ class StorageManager:
             print(f"Error saving image: {e}")
             return None
 
+    def get_file_size(self, image_url):
+        """Size in bytes of a saved image, given the URL returned by save_image."""
+        if self.storage_type != 'local':
+            return 0
+        try:
+            return os.path.getsize(os.path.join(self.base_dir, os.path.basename(image_url)))
+        except OSError:
+            return 0
+
+    def get_image_url(self, filename):
+        """Public URL of a stored image (same form as returned by save_image)."""
+        return f"/{self.base_dir}/{filename}"
+
+    def list_filenames(self):
+        """Names of all stored image files."""
+        if self.storage_type != 'local':
+            return []
+        return [f for f in os.listdir(self.base_dir) if f.endswith(IMAGE_EXTENSIONS)]
+
+    def change_token(self):
+        """
+        Value that changes whenever an image or its metadata is added, removed or
+        renamed, by this process or any other one sharing the directories.
+        """
+        if self.storage_type != 'local':
+            return None
+        return (os.stat(self.base_dir).st_mtime_ns, os.stat(self.metadata_dir).st_mtime_ns)
+
+    def list_images(self, start_date=None, end_date=None, model=None, style=None):
+        """
+        Lists stored images (oldest first) with their metadata, optionally filtered.
+        Dates are datetime.date objects (inclusive); model/style match the
+        model_id/style_id recorded at generation time.
+        Returns a list of dicts: {filename, path, size, created_at, metadata}.
+        """
+        if self.storage_type != 'local':
+            return []
+
+        results = []
+        for filename in sorted(os.listdir(self.base_dir)):
+            if not filename.endswith(IMAGE_EXTENSIONS):
+                continue
+
+            created_at = self._parse_timestamp(filename)
+            if created_at is None:
+                continue
+            if start_date and created_at.date() < start_date:
+                continue
+            if end_date and created_at.date() > end_date:
+                continue
+
+            metadata = self.load_metadata(filename)
+            if model and metadata.get('model_id') != model:
+                continue
+            if style and metadata.get('style_id') != style:
+                continue
+
+            file_path = os.path.join(self.base_dir, filename)
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                continue # Evicted while listing
+
+            results.append({
+                "filename": filename,
+                "path": file_path,
+                "size": size,
+                "created_at": created_at,
+                "metadata": metadata
+            })
+        return results
+
+    def load_metadata(self, filename):
+        """Returns the metadata saved alongside an image, or {} if there is none."""
+        try:
+            with open(self._metadata_path(filename), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def replace_image(self, filename, new_filename, tmp_path, metadata=None):
+        """
+        Swaps a stored image for a re-encoded copy written to tmp_path, which must be
+        on the same filesystem as base_dir (but not publicly served).
+        The new file is moved into place before the old one is removed, so the
+        image is reachable under one of the two names at every point.
+        The original mtime is kept so cleanup still evicts in generation order.
+        """
+        file_path = os.path.join(self.base_dir, filename)
+        new_path = os.path.join(self.base_dir, new_filename)
+
+        stat = os.stat(file_path)
+        os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+        os.replace(tmp_path, new_path)
+
+        if metadata is not None:
+            self._write_metadata(new_filename, metadata)
+
+        if new_filename != filename:
+            if self.prompt_index is not None:
+                self.prompt_index.rename(filename, new_filename)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def update_metadata(self, filename, metadata):
+        """Overwrites the metadata saved alongside an image."""
+        self._write_metadata(filename, metadata)
+
+    def resolve_filename(self, filename):
+        """
+        Finds the current name of an image that may have been re-encoded to
+        another format (e.g. x.png -> x.webp). Returns None if it is gone.
+        """
+        stem = os.path.splitext(filename)[0]
+        for ext in IMAGE_EXTENSIONS:
+            if os.path.exists(os.path.join(self.base_dir, stem + ext)):
+                return stem + ext
+        return None
+
+    def _write_metadata(self, filename, metadata):
+        try:
+            # Write to a temp file first so readers never see a half-written sidecar
+            metadata_path = self._metadata_path(filename)
+            tmp_path = f"{metadata_path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False)
+            os.replace(tmp_path, metadata_path)
+        except Exception as e:
+            print(f"Error saving metadata for {filename}: {e}")
+
+    def _metadata_path(self, filename):
+        # Sidecar file: YYYYMMDD_HHMMSS_uuid.png -> <metadata_dir>/YYYYMMDD_HHMMSS_uuid.json
+        return os.path.join(self.metadata_dir, os.path.splitext(filename)[0] + '.json')
+
+    def _move_public_metadata(self):
+        """Moves sidecars written by older versions out of the (publicly served) gallery folder."""
+        try:
+            for filename in os.listdir(self.base_dir):
+                if filename.endswith('.json') and self._parse_timestamp(filename):
+                    os.replace(os.path.join(self.base_dir, filename), os.path.join(self.metadata_dir, filename))
+        except Exception as e:
+            print(f"Error moving metadata out of {self.base_dir}: {e}")
+
+    @staticmethod
+    def _parse_timestamp(filename):
+        try:
+            return datetime.strptime(filename[:15], "%Y%m%d_%H%M%S")
+        except ValueError:
+            return None
+
     def _is_safe_url(self, url):
         """
         Validates the URL to prevent SSRF (Server-Side Request Forgery).
@@ -113,19 +286,27 @@ class StorageManager:
         """
         Maintains the number of files within the limit by deleting the oldest ones.
         """
-        try:
-            files = [os.path.join(self.base_dir, f) for f in os.listdir(self.base_dir) 
-                     if f.endswith(('.png', '.jpg', '.jpeg'))]
+        with self._cleanup_lock:
+            try:
+                files = [os.path.join(self.base_dir, f) for f in os.listdir(self.base_dir) 
+                         if f.endswith(IMAGE_EXTENSIONS)]
             
-            if len(files) > self.max_files:
-                # Sort files by modification time (oldest first)
-                files.sort(key=os.path.getmtime)
+                if len(files) > self.max_files:
+                    # Sort files by modification time (oldest first)
+                    files.sort(key=os.path.getmtime)
                 
-                # Delete excess files
-                num_to_delete = len(files) - self.max_files
-                for i in range(num_to_delete):
-                    os.remove(files[i])
-                    print(f"Deleted old image: {files[i]}")
+                    # Delete excess files
+                    num_to_delete = len(files) - self.max_files
+                    for i in range(num_to_delete):
+                        os.remove(files[i])
+                        print(f"Deleted old image: {files[i]}")
                     
-        except Exception as e:
-            print(f"Error during cleanup: {e}")
+                        if self.prompt_index is not None:
+                            self.prompt_index.remove(os.path.basename(files[i]))
+                    
+                        metadata_path = self._metadata_path(os.path.basename(files[i]))
+                        if os.path.exists(metadata_path):
+                            os.remove(metadata_path)
+                    
+            except Exception as e:
+                print(f"Error during cleanup: {e}")
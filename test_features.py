@@ -0,0 +1,338 @@
+import io
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from datetime import datetime
+
+from storage import StorageManager
+
+# Offline checks for the gallery/storage features. No API keys or running server needed.
+# Usage: python test_features.py  (or: python -m pytest test_features.py)
+
+
+def _make_gallery(tmp_dir, count=2, size=300000):
+    """Creates a StorageManager in tmp_dir with `count` fake images and metadata."""
+    storage = StorageManager(
+        base_dir=os.path.join(tmp_dir, 'gallery'),
+        metadata_dir=os.path.join(tmp_dir, 'metadata')
+    )
+    for i in range(count):
+        filename = f"2024010{i + 1}_120000_abcd000{i}.png"
+        with open(os.path.join(storage.base_dir, filename), 'wb') as f:
+            f.write(os.urandom(size + i))
+        storage.update_metadata(filename, {
+            "subject_prompt": f"test prompt {i}",
+            "final_prompt": f"test prompt {i}",
+            "model_id": f"model_{i % 2 + 1}",
+            "style_id": "none"
+        })
+    return storage
+
+
+def test_export():
+    print("\n📦 Testing gallery export...")
+    from export import stream_archive
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        storage = _make_gallery(tmp_dir)
+        images = storage.list_images()
+        expected = [img["filename"] for img in images] + ["manifest.json"]
+
+        data = b"".join(stream_archive(images, "zip", storage))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist() == expected
+
+        data = b"".join(stream_archive(images, "tar", storage))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            assert tf.getnames() == expected
+            assert [m.size for m in tf.getmembers()[:-1]] == [img["size"] for img in images]
+
+        # After planning: one image is re-encoded (renamed), the other evicted
+        renamed = images[0]["filename"].replace(".png", ".webp")
+        os.replace(images[0]["path"], os.path.join(storage.base_dir, renamed))
+        os.remove(images[1]["path"])
+        for archive_format in ("zip", "tar"):
+            data = b"".join(stream_archive(images, archive_format, storage))
+            if archive_format == "zip":
+                with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                    names, manifest = zf.namelist(), json.loads(zf.read("manifest.json"))
+            else:
+                with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+                    names, manifest = tf.getnames(), json.load(tf.extractfile("manifest.json"))
+            assert names == [renamed, "manifest.json"]
+            assert manifest["count"] == 1 and manifest["images"][0]["filename"] == renamed
+            assert manifest["skipped"] == [images[1]["filename"]]
+
+        # Metadata must not be written into the publicly served gallery folder
+        assert not [f for f in os.listdir(storage.base_dir) if f.endswith('.json')]
+        assert len(storage.list_images(model="model_1")) == 1
+        print("✅ Success: zip and tar exports are valid and the manifest matches their contents.")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_event_log():
+    print("\n📊 Testing event log aggregation...")
+    from events import EventLog, LATENCY_BUCKETS_MS, _percentile
+
+    # Percentiles come from histogram bucket upper bounds
+    hist = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    hist[0] = 90
+    hist[10] = 10
+    assert _percentile(hist, 0.5) == LATENCY_BUCKETS_MS[0]
+    assert _percentile(hist, 0.95) == LATENCY_BUCKETS_MS[10]
+    assert _percentile([0] * len(hist), 0.95) is None
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Two logs on one directory behave like two Gunicorn workers
+        worker_a = EventLog(log_dir=tmp_dir, max_bytes=1000, flush_interval=0.05)
+        worker_b = EventLog(log_dir=tmp_dir, max_bytes=1000, flush_interval=0.05)
+        for i in range(5):
+            worker_a.record({"model": "model_1", "status": "ok", "stages": {"upstream": 1000 + i},
+                             "upstream_status": 200, "bytes_saved": 100, "cache": "miss"})
+        for _ in range(3):
+            worker_b.record({"model": "model_2", "status": "error", "stages": {"upstream": 50},
+                             "upstream_status": 503, "cache": "miss"})
+        worker_a.flush()
+        worker_b.flush()
+
+        for stats in (worker_a.stats(), EventLog(log_dir=tmp_dir).stats()):
+            per_day = list(stats["requests_per_model_per_day"].values())[0]
+            assert per_day == {"model_1": 5, "model_2": 3}
+            assert stats["error_rates"]["model_2"]["error_rate"] == 1.0
+            assert stats["error_rates"]["model_1"]["errors"] == 0
+            assert stats["latency_ms"]["upstream"]["count"] == 8
+            assert stats["upstream_status"] == {"200": 5, "503": 3}
+            assert stats["bytes_saved"] == 500
+
+        # The small max_bytes forces rotation
+        assert os.path.exists(os.path.join(tmp_dir, "events.jsonl.1"))
+        print("✅ Success: events from both workers are aggregated and the log rotates.")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_prompt_index():
+    print("\n🔎 Testing near-duplicate prompt index...")
+    from similarity import PromptIndex
+
+    index = PromptIndex()
+    index.add("a.png", "A cute cat sitting on a windowsill at sunset, watercolor painting")
+    index.add("b.png", "A cyberpunk city at night, neon lights, rain")
+
+    matches = index.lookup("a CUTE cat sitting on a windowsill at sunset; watercolor painting!")
+    assert matches[0] == ("a.png", 1.0)
+    assert "b.png" not in [m[0] for m in matches]
+
+    index.rename("a.png", "a.webp")
+    assert index.lookup("A cute cat sitting on a windowsill at sunset, watercolor painting")[0][0] == "a.webp"
+
+    index.remove("a.webp")
+    assert index.lookup("A cute cat sitting on a windowsill at sunset, watercolor painting") == []
+    assert len(index) == 1
+
+    # A long shared style suffix must not make different subjects look alike
+    from similarity import minhash, estimate_similarity
+    ghibli = (", Studio Ghibli style, Hayao Miyazaki, anime, vibrant colors, peaceful atmosphere, "
+              "detailed background art, hand drawn style, summer clouds")
+    assert estimate_similarity(minhash("a cat" + ghibli), minhash("a dog" + ghibli)) >= 0.7
+    index.add("cat.png", PromptIndex.indexed_prompt({"subject_prompt": "a cat", "final_prompt": "a cat" + ghibli}))
+    assert index.lookup("a dog") == []
+
+    # Two StorageManagers on one gallery behave like two Gunicorn workers
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        worker_a = _make_gallery(tmp_dir, count=2, size=10)
+        worker_b = StorageManager(base_dir=worker_a.base_dir, metadata_dir=worker_a.metadata_dir, max_files=1)
+        index_a = PromptIndex()
+        index_a.build(worker_a)
+        assert len(index_a) == 2
+
+        worker_b._cleanup_local_storage()  # Worker B evicts the oldest image
+        index_a.sync(worker_a)
+        assert [m[0] for m in index_a.lookup("test prompt 0", min_similarity=1.0)] == []
+        assert len(index_a) == 1
+        print("✅ Success: add, remove, rename and cross-worker sync work.")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_recompression():
+    print("\n🗜️  Testing gallery recompression...")
+    from recompress import GalleryRecompressor, Image
+    from similarity import PromptIndex
+
+    if Image is None:
+        print("⚠️ Skipped: Pillow is not installed.")
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        storage = _make_gallery(tmp_dir, count=0)
+        storage.prompt_index = PromptIndex()
+        old_file = "20200101_120000_aaaa0000.png"  # Outside the hot window
+        hot_file = datetime.now().strftime("%Y%m%d_%H%M%S") + "_bbbb0000.png"
+        for filename in (old_file, hot_file):
+            # Uncompressed PNG so WebP is guaranteed to be smaller
+            image = Image.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 50).convert("RGB")
+            image.save(os.path.join(storage.base_dir, filename), compress_level=0)
+            storage.update_metadata(filename, {"subject_prompt": f"prompt for {filename}"})
+            storage.prompt_index.add(filename, f"prompt for {filename}")
+        old_size = os.path.getsize(os.path.join(storage.base_dir, old_file))
+
+        state_dir = os.path.join(tmp_dir, 'state')
+        recompressor = GalleryRecompressor(storage, state_dir=state_dir, cpu_budget=1.0, io_budget_bytes=0)
+        recompressor.run_once()
+
+        new_file = old_file.replace(".png", ".webp")
+        assert sorted(os.listdir(storage.base_dir)) == sorted([new_file, hot_file])
+        assert storage.resolve_filename(old_file) == new_file
+        assert storage.load_metadata(new_file)["original_bytes"] == old_size
+        assert storage.prompt_index.lookup(f"prompt for {old_file}")[0][0] == new_file
+
+        stats = recompressor.stats()
+        assert stats["images_recompressed"] == 1
+        assert stats["bytes_reclaimed"] == old_size - os.path.getsize(os.path.join(storage.base_dir, new_file))
+
+        # A second pass has nothing left to do
+        recompressor.run_once()
+        assert recompressor.stats()["images_recompressed"] == 1
+        assert os.listdir(os.path.join(state_dir, 'tmp')) == []
+
+        # An image that can't be decoded is retried max_attempts times, then left alone
+        bad_file = "20200102_120000_cccc0000.png"
+        with open(os.path.join(storage.base_dir, bad_file), 'wb') as f:
+            f.write(b"not an image")
+        recompressor.max_attempts = 2
+        for _ in range(3):
+            recompressor.run_once()
+        assert recompressor.stats()["errors"] == 2
+        assert storage.load_metadata(bad_file)["recompress_failures"] == 2
+        print(f"✅ Success: reclaimed {stats['bytes_reclaimed']} bytes, hot image left untouched.")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_generate():
+    print("\n🖼️  Testing /generate (multiple images, reuse)...")
+    tmp_dir = tempfile.mkdtemp()
+    os.environ.setdefault("IMAGE_GEN_API_KEY", "test-key")
+    os.environ.update({
+        "MODEL_2_ENDPOINT": "test-endpoint",
+        "MODEL_2_SUPPORTS_N": "false",
+        "EVENT_LOG_DIR": os.path.join(tmp_dir, "logs"),
+        "GALLERY_METADATA_DIR": os.path.join(tmp_dir, "metadata")
+    })
+    import app
+
+    # Importing the app must not start re-encoding the real gallery
+    assert app.recompressor._thread is None
+    from types import SimpleNamespace
+
+    class UpstreamError(Exception):
+        status_code = 503
+
+    calls = []
+
+    def fake_generate(**kwargs):
+        # Every third call fails, like a flaky upstream
+        calls.append(kwargs)
+        if len(calls) % 3 == 0:
+            raise UpstreamError("upstream overloaded")
+        return SimpleNamespace(data=[SimpleNamespace(url=f"https://example.com/{len(calls)}.png")])
+
+    original_generate, original_save = app.client.images.generate, app.storage_manager.save_image
+    original_access_code, original_storage, original_text_client = app.ACCESS_CODE, app.storage_manager, app.text_client
+    app.text_client = None  # Plain prompt + style suffix, no LLM call
+    app.client.images.generate = fake_generate
+    app.storage_manager.save_image = lambda url, metadata=None: f"/static/gallery/{os.path.basename(url)}"
+    app.rate_limit_store["counts"]["model_2"] = 0
+    try:
+        client = app.app.test_client()
+        for bad_value in (True, 2.9, "2", 0, app.MAX_IMAGES_PER_REQUEST + 1):
+            response = client.post('/generate', json={"prompt": "#原图 test", "num_images": bad_value})
+            assert response.status_code == 400, bad_value
+
+        response = client.post('/generate', json={"prompt": "#原图 test", "num_images": 3})
+        data = response.get_json()
+        assert response.status_code == 200
+        assert len(calls) == 3 and all("n" not in call for call in calls)
+        assert len(data["images"]) == 2 and data["failed_calls"] == 1 and data["warning"]
+        # Quota is charged per image actually returned
+        assert app.rate_limit_store["counts"]["model_2"] == 2
+
+        app.event_log.flush()
+        stats = app.event_log.stats()
+        assert stats["error_rates"]["model_2"]["errors"] == 1
+
+        # Admin endpoints take the access code from a header, never the (logged) URL
+        app.ACCESS_CODE = "secret"
+        assert client.get('/admin/stats?access_code=secret').status_code == 401
+        assert client.get('/admin/stats', headers={"X-Access-Code": "secret"}).status_code == 200
+        assert client.get('/export?start=2999-01-01', headers={"X-Access-Code": "secret"}).status_code == 200
+        app.ACCESS_CODE = original_access_code
+
+        # Reuse: a stored "a cat" in Ghibli style, in a throwaway gallery
+        app.storage_manager = _make_gallery(tmp_dir, count=1, size=10)
+        app.storage_manager.save_image = lambda url, metadata=None: f"/static/gallery/{os.path.basename(url)}"
+        app.storage_manager.update_metadata(app.storage_manager.list_filenames()[0], {
+            "original_prompt": "a cat", "subject_prompt": "a cat", "final_prompt": "a cat, Studio Ghibli style",
+            "model_id": "model_2", "style_id": "ghibli", "raw_mode": False
+        })
+        calls.clear()
+
+        def generate(prompt, style_id):
+            return client.post('/generate', json={"prompt": prompt, "style_id": style_id, "reuse_similar": True}).get_json()
+
+        data = generate("a dog", "ghibli")
+        assert data["similar_images"] == [] and not data["reused"]
+        data = generate("a cat", "watercolor")
+        assert len(data["similar_images"]) == 1 and not data["reused"]
+        calls_before = len(calls)
+        data = generate("A cat!", "ghibli")
+        assert data["reused"] and len(calls) == calls_before
+
+        # More images than the default suggestion limit can still be reused as a full set
+        assert client.get('/config').get_json()["max_images"] == app.MAX_IMAGES_PER_REQUEST
+        original_max_images, app.MAX_IMAGES_PER_REQUEST = app.MAX_IMAGES_PER_REQUEST, 6
+        try:
+            app.storage_manager = _make_gallery(os.path.join(tmp_dir, "many"), count=6, size=10)
+            for filename in app.storage_manager.list_filenames():
+                app.storage_manager.update_metadata(filename, {
+                    "subject_prompt": "a cat", "model_id": "model_2", "style_id": "ghibli"
+                })
+            data = client.post('/generate', json={"prompt": "a cat", "style_id": "ghibli",
+                                                  "reuse_similar": True, "num_images": 6}).get_json()
+            assert data["reused"] and len(data["images"]) == 6 and len(calls) == calls_before
+        finally:
+            app.MAX_IMAGES_PER_REQUEST = original_max_images
+
+        # The old-URL redirect must not reveal whether files outside the gallery exist
+        from werkzeug.exceptions import NotFound
+        app.storage_manager = original_storage
+        with open(os.path.join(tmp_dir, "probe.png"), 'wb') as f:
+            f.write(b"x")
+        probe = os.path.join(os.path.relpath(tmp_dir, original_storage.base_dir), "probe.webp")
+        assert original_storage.resolve_filename(probe)  # Reachable by path traversal
+        with app.app.test_request_context(f"/{original_storage.base_dir}/{probe}"):
+            assert isinstance(app.not_found(NotFound()), NotFound)
+        print("✅ Success: per-image quota, partial failures, validation and reuse matching work.")
+    finally:
+        app.ACCESS_CODE, app.storage_manager, app.text_client = original_access_code, original_storage, original_text_client
+        app.client.images.generate, app.storage_manager.save_image = original_generate, original_save
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    print("🚀 Starting Feature Tests...")
+    test_export()
+    test_event_log()
+    test_prompt_index()
+    test_recompression()
+    test_generate()